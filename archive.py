@@ -0,0 +1,268 @@
+"""
+Archive of parsed sessions, one file for many sessions:
+
+    header          MAGIC, version, session count, string table offset, session index offset
+    session blocks  one zstd frame per session
+    string table    player names, action codes, cards and session names
+    session index   fixed-width entry per session, see INDEX_ENTRY
+
+A decompressed session block holds the final stacks and ledger, an offset per round and then the rounds,
+so a single round can be decoded without touching the others.
+"""
+import mmap
+import struct
+import zstandard
+from lamda_function import Action, Round
+
+
+MAGIC = b"PKAR"
+VERSION = 2
+HEADER = struct.Struct("<4sHHIQQ")
+# session name, block offset, compressed size, decompressed size, number of rounds
+INDEX_ENTRY = struct.Struct("<IQIII")
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+PLAYER = struct.Struct("<Iii")
+AMOUNT = struct.Struct("<Ii")
+MOVE = struct.Struct("<IIi")
+ROUND = struct.Struct("<IiH")
+CARDS = struct.Struct("<5i")
+NO_CARDS = 255
+
+
+class ArchiveWriter:
+    """
+    Pass as Parser.parse(..., archive=writer) or call add_session with a parsed Game
+    """
+
+    def __init__(self, path, level=10):
+        self.file = open(path, "wb")
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.strings = []
+        self.string_ids = {}
+        self.index = []
+        self.session_names = set()
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _sid(self, s):
+        sid = self.string_ids.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self.string_ids[s] = sid
+            self.strings.append(s)
+        return sid
+
+    def _cards(self, cards):
+        if cards is None:
+            return U8.pack(NO_CARDS)
+        return U8.pack(len(cards)) + b"".join(U32.pack(self._sid(card)) for card in cards)
+
+    def _encode_round(self, round):
+        out = [ROUND.pack(round.number, self._sid(round.dealer), len(round.initial_amounts))]
+        out.extend(AMOUNT.pack(self._sid(player), amt) for player, amt in round.initial_amounts.items())
+
+        board = list(round.flop or [None] * 3)[:3] + [round.turn, round.river]
+        out.append(CARDS.pack(*[-1 if card is None else self._sid(card) for card in board]))
+
+        for moves in [round.preflop_moves, round.flop_moves, round.turn_moves, round.river_moves]:
+            out.append(U16.pack(len(moves)))
+            out.extend(MOVE.pack(self._sid(m.player), self._sid(m.action_name), m.amount) for m in moves)
+
+        out.append(U16.pack(len(round.winners)))
+        for (player, hand, amt) in round.winners:
+            out.append(AMOUNT.pack(self._sid(player), amt))
+            out.append(self._cards(hand))
+
+        out.append(U16.pack(len(round.known_hands)))
+        for player, cards in round.known_hands.items():
+            out.append(U32.pack(self._sid(player)))
+            out.append(self._cards(cards))
+        return b"".join(out)
+
+    def add_session(self, name, game):
+        if name in self.session_names:
+            raise ValueError(f"Session {name} is already in the archive")
+        if game.rounds is None:
+            raise ValueError(f"Session {name} has no rounds to archive (see parallel_parse)")
+        self.session_names.add(name)
+        players = [PLAYER.pack(self._sid(player), amt, game.players_ledger.get(player, 0))
+                   for player, amt in game.players.items()]
+        rounds = [self._encode_round(round) for round in game.rounds]
+
+        offsets = []
+        position = 0
+        for data in rounds:
+            offsets.append(U32.pack(position))
+            position += len(data)
+
+        raw = b"".join([U32.pack(len(rounds)), U16.pack(len(players))] + players + offsets + rounds)
+        block = self.compressor.compress(raw)
+        self.index.append((self._sid(name), self.file.tell(), len(block), len(raw), len(rounds)))
+        self.file.write(block)
+
+    def close(self):
+        if self.file.closed:
+            return
+        strings_offset = self.file.tell()
+        self.file.write(U32.pack(len(self.strings)))
+        for s in self.strings:
+            data = s.encode("utf-8")
+            self.file.write(U16.pack(len(data)))
+            self.file.write(data)
+
+        index_offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, len(self.index), strings_offset, index_offset))
+        self.file.close()
+
+
+class SessionView:
+    """
+    Read-only stand-in for Game, rounds are decoded on first access
+    """
+
+    def __init__(self, reader, name, raw, num_rounds):
+        self.reader = reader
+        self.name = name
+        self._raw = raw
+        self.num_rounds = num_rounds
+        self.players = {}
+        self.players_ledger = {}
+        pos = U32.size
+        (num_players,) = U16.unpack_from(raw, pos)
+        pos += U16.size
+        for _ in range(num_players):
+            sid, amt, ledger = PLAYER.unpack_from(raw, pos)
+            pos += PLAYER.size
+            self.players[reader.strings[sid]] = amt
+            self.players_ledger[reader.strings[sid]] = ledger
+        self._offsets_pos = pos
+        self._rounds_pos = pos + num_rounds * U32.size
+        self._rounds = None
+
+    @property
+    def rounds(self):
+        if self._rounds is None:
+            self._rounds = [self.round(i) for i in range(self.num_rounds)]
+        return self._rounds
+
+    def get_rounds(self):
+        return [x for x in self.rounds if x.total_money_in_round()]
+
+    def _cards(self, pos):
+        (count,) = U8.unpack_from(self._raw, pos)
+        pos += U8.size
+        if count == NO_CARDS:
+            return None, pos
+        strings = self.reader.strings
+        cards = [strings[U32.unpack_from(self._raw, pos + i * U32.size)[0]] for i in range(count)]
+        return cards, pos + count * U32.size
+
+    def round(self, index):
+        """
+        Decode the round at position index (0 based, Round.number is 1 based)
+        """
+        if self._rounds is not None:
+            return self._rounds[index]
+        raw = self._raw
+        strings = self.reader.strings
+        (offset,) = U32.unpack_from(raw, self._offsets_pos + index * U32.size)
+        pos = self._rounds_pos + offset
+
+        number, dealer, num_initial = ROUND.unpack_from(raw, pos)
+        pos += ROUND.size
+        initial_amounts = {}
+        for _ in range(num_initial):
+            sid, amt = AMOUNT.unpack_from(raw, pos)
+            pos += AMOUNT.size
+            initial_amounts[strings[sid]] = amt
+        round = Round(strings[dealer], initial_amounts, number)
+
+        board = [None if sid < 0 else strings[sid] for sid in CARDS.unpack_from(raw, pos)]
+        pos += CARDS.size
+        round.flop = board[:3] if board[0] is not None else None
+        round.turn = board[3]
+        round.river = board[4]
+
+        for moves in [round.preflop_moves, round.flop_moves, round.turn_moves, round.river_moves]:
+            (num_moves,) = U16.unpack_from(raw, pos)
+            pos += U16.size
+            for _ in range(num_moves):
+                player, action_name, amount = MOVE.unpack_from(raw, pos)
+                pos += MOVE.size
+                moves.append(Action(strings[player], strings[action_name], amount))
+
+        (num_winners,) = U16.unpack_from(raw, pos)
+        pos += U16.size
+        for _ in range(num_winners):
+            sid, amt = AMOUNT.unpack_from(raw, pos)
+            pos += AMOUNT.size
+            hand, pos = self._cards(pos)
+            round.winners.append((strings[sid], hand, amt))
+
+        (num_known,) = U16.unpack_from(raw, pos)
+        pos += U16.size
+        for _ in range(num_known):
+            (sid,) = U32.unpack_from(raw, pos)
+            pos += U32.size
+            cards, pos = self._cards(pos)
+            round.known_hands[strings[sid]] = cards
+        return round
+
+
+class ArchiveReader:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.decompressor = zstandard.ZstdDecompressor()
+        magic, version, _, num_sessions, strings_offset, index_offset = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} session archive")
+
+        self.strings = []
+        (num_strings,) = U32.unpack_from(self.map, strings_offset)
+        pos = strings_offset + U32.size
+        for _ in range(num_strings):
+            (length,) = U16.unpack_from(self.map, pos)
+            pos += U16.size
+            self.strings.append(self.map[pos:pos + length].decode("utf-8"))
+            pos += length
+
+        self.index_offset = index_offset
+        self.num_sessions = num_sessions
+        self.session_ids = {}
+        for i in range(num_sessions):
+            entry = INDEX_ENTRY.unpack_from(self.map, index_offset + i * INDEX_ENTRY.size)
+            self.session_ids[self.strings[entry[0]]] = i
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def sessions(self):
+        return list(self.session_ids.keys())
+
+    def session(self, name) -> SessionView:
+        entry = INDEX_ENTRY.unpack_from(self.map, self.index_offset + self.session_ids[name] * INDEX_ENTRY.size)
+        _, offset, size, raw_size, num_rounds = entry
+        raw = self.decompressor.decompress(self.map[offset:offset + size], max_output_size=raw_size)
+        return SessionView(self, name, raw, num_rounds)
+
+    def round(self, name, number) -> Round:
+        return self.session(name).round(number - 1)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
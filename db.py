@@ -1,18 +1,359 @@
 import json
+import queue
+import random
+import threading
+import time
 import boto3 as b3
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Attr
 
+THROTTLE_ERRORS = ['ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded']
+
+
+class WriteThrottledError(Exception):
+    pass
+
+
+def _is_throttled(error):
+    code = error.response['Error']['Code']
+    if code in THROTTLE_ERRORS:
+        return True
+    if code == 'TransactionCanceledException':
+        reasons = error.response.get('CancellationReasons', [])
+        return any(x.get('Code') in ['ThrottlingError', 'ProvisionedThroughputExceeded'] for x in reasons)
+    return False
+
+
+def _consumed_capacity(response):
+    consumed = response.get('ConsumedCapacity')
+    if not consumed:
+        return None
+    # Transactions report one entry per table
+    if isinstance(consumed, list):
+        return sum(float(x.get('CapacityUnits', 0)) for x in consumed)
+    return float(consumed.get('CapacityUnits', 0))
+
+
+class TokenBucket:
+    """
+    Write capacity units per second. Tokens may go negative when a write consumed more than was
+    reserved for it, or when a write costs more than the burst and was let through on a full bucket,
+    later writes then wait for the debt to be refilled.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount):
+        while True:
+            with self.lock:
+                self._refill()
+                # The bucket never holds more than burst, the rest of a larger write is charged as debt
+                needed = min(amount, self.burst)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount):
+        with self.lock:
+            self.tokens -= amount
+
+
+class WriteScheduler:
+    """
+    Paces writes to a table by the capacity DynamoDB reports as consumed. The rate grows additively while
+    writes succeed and halves on throttling (with jittered exponential backoff before the retry), so it
+    settles around the table's capacity. Writes botocore had to retry count as throttled too.
+
+    Without a rate (on-demand tables) writes are not paced until the first throttle, pacing then starts
+    from the capacity consumed in the last second. submit() queues a write for the background worker and
+    blocks once max_queue writes are pending.
+    """
+
+    def __init__(self, rate=None, max_rate=None, min_rate=1.0, max_queue=100, max_retries=8,
+                 base_delay=0.05, max_delay=5.0):
+        self.bucket = TokenBucket(rate, max(rate, 1.0)) if rate else None
+        # Capacity consumed since window_start while not paced
+        self.window_start = time.monotonic()
+        self.window_consumed = 0.0
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Expected capacity units of the next write, updated from ConsumedCapacity
+        self.estimate = 1.0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.errors = []
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def _consumed(self, consumed):
+        now = time.monotonic()
+        if now - self.window_start > 1.0:
+            self.window_start = now
+            self.window_consumed = 0.0
+        self.window_consumed += consumed
+
+    def _throttled(self):
+        with self.lock:
+            if self.bucket is None:
+                rate = max(self.window_consumed, self.min_rate)
+                self.bucket = TokenBucket(rate, max(rate, 1.0))
+        self._set_rate(self.bucket.rate / 2)
+
+    def _set_rate(self, rate):
+        if self.max_rate:
+            rate = min(rate, self.max_rate)
+        rate = max(rate, self.min_rate)
+        with self.bucket.lock:
+            self.bucket.rate = rate
+            self.bucket.burst = max(rate, 1.0)
+
+    def run(self, fn, **kwargs):
+        """
+        Run a single write now, waiting for capacity and retrying throttled attempts
+        """
+        kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+        for attempt in range(self.max_retries + 1):
+            bucket = self.bucket
+            reserved = self.estimate
+            if bucket:
+                bucket.acquire(reserved)
+            try:
+                response = fn(**kwargs)
+            except ClientError as e:
+                if not _is_throttled(e):
+                    raise
+                self._throttled()
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+                continue
+
+            consumed = _consumed_capacity(response)
+            if consumed is not None:
+                if bucket:
+                    bucket.adjust(consumed - reserved)
+                else:
+                    self._consumed(consumed)
+                self.estimate = 0.8 * self.estimate + 0.2 * consumed
+            if response.get('ResponseMetadata', {}).get('RetryAttempts', 0):
+                self._throttled()
+            elif bucket:
+                self._set_rate(bucket.rate + self.estimate / bucket.rate)
+            return response
+
+        raise WriteThrottledError(f"Write still throttled after {self.max_retries} retries")
+
+    def _work(self):
+        while True:
+            fn, args = self.queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, daemon=True)
+                self.worker.start()
+        self.queue.put((fn, args))
+
+    def flush(self):
+        """
+        Wait for all submitted writes, re-raising the first failure
+        """
+        self.queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+
+_write_schedulers = {}
+
+
+def get_write_scheduler(table_name, dynamodb):
+    scheduler = _write_schedulers.get(table_name)
+    if scheduler is None:
+        if not dynamodb:
+            dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+        try:
+            # 0 for on-demand tables
+            capacity = dynamodb.Table(table_name).provisioned_throughput.get('WriteCapacityUnits', 0)
+        except ClientError:
+            capacity = 0
+        if capacity:
+            scheduler = WriteScheduler(rate=float(capacity), max_rate=float(capacity))
+        else:
+            scheduler = WriteScheduler()
+        _write_schedulers[table_name] = scheduler
+    return scheduler
+
 
 def update_stats_by_date(merged_data, dynamodb):
     if not dynamodb:
         dynamodb = b3.resource('dynamodb', region_name='us-east-1')
         
     table = dynamodb.Table('stats_by_date')
-    response = table.put_item(Item=merged_data)
+    response = get_write_scheduler('stats_by_date', dynamodb).run(table.put_item, Item=merged_data)
     return response
 
 
+STATS_VERSION_UPDATE = {
+    'TableName': 'stats_meta',
+    'Key': {'PK': 'stats_version'},
+    'UpdateExpression': 'ADD Version :one',
+    'ExpressionAttributeValues': {':one': 1}
+}
+
+
+def get_stats_version(dynamodb):
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+
+    table = dynamodb.Table('stats_meta')
+    response = table.get_item(Key={'PK': 'stats_version'}, ConsistentRead=True)
+    return int(response.get('Item', {}).get('Version', 0))
+
+
+def bump_stats_version(dynamodb):
+    """
+    Invalidates every cached read of the stats tables (see stats_queries)
+    """
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+
+    table = dynamodb.Table(STATS_VERSION_UPDATE['TableName'])
+    response = get_write_scheduler('stats_meta', dynamodb).run(
+        table.update_item,
+        Key=STATS_VERSION_UPDATE['Key'],
+        UpdateExpression=STATS_VERSION_UPDATE['UpdateExpression'],
+        ExpressionAttributeValues=STATS_VERSION_UPDATE['ExpressionAttributeValues'],
+        ReturnValues="UPDATED_NEW"
+    )
+    return response
+
+
+def update_stats_columns(player, date_played, data, dynamodb):
+    """
+    Set only the given columns of an existing stats_by_date row. Returns False (and writes nothing) if
+    there is no row for the player and date
+    """
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+
+    table = dynamodb.Table('stats_by_date')
+    names = {f"#c{i}": column for i, column in enumerate(data.keys())}
+    values = {f":v{i}": value for i, value in enumerate(data.values())}
+    try:
+        get_write_scheduler('stats_by_date', dynamodb).run(
+            table.update_item,
+            Key={'Player': player, 'Date_Played': date_played},
+            UpdateExpression="set " + ", ".join(f"#c{i}=:v{i}" for i in range(len(data))),
+            ConditionExpression='attribute_exists(Player)',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+def processed_object_id(bucket, key, etag):
+    # S3 reports ETags wrapped in quotes
+    etag = etag.strip('"')
+    return f"{bucket}/{key}#{etag}"
+
+
+OBJECT_STATUS = {'#s': 'Status', '#e': 'Expires'}
+
+
+def claim_object(processed_object, lease, dynamodb):
+    """
+    Mark an object as being processed for lease seconds. Returns False if it was already processed or
+    another run holds an unexpired claim. Entries without a Status were written as processed
+    """
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+
+    table = dynamodb.Table('processed_objects')
+    now = int(time.time())
+    try:
+        get_write_scheduler('processed_objects', dynamodb).run(
+            table.put_item,
+            Item={'PK': processed_object, 'Status': 'processing', 'Expires': now + int(lease)},
+            ConditionExpression='attribute_not_exists(PK) OR (#s = :processing AND #e < :now)',
+            ExpressionAttributeNames=OBJECT_STATUS,
+            ExpressionAttributeValues={':processing': 'processing', ':now': now}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+def release_object(processed_object, dynamodb):
+    """
+    Drop a claim after a failed run so the retried notification can claim the object again
+    """
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+
+    table = dynamodb.Table('processed_objects')
+    try:
+        get_write_scheduler('processed_objects', dynamodb).run(
+            table.delete_item,
+            Key={'PK': processed_object},
+            ConditionExpression='#s = :processing',
+            ExpressionAttributeNames={'#s': 'Status'},
+            ExpressionAttributeValues={':processing': 'processing'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def mark_object_processed(processed_object, dynamodb):
+    """
+    Turn a claim into a processed entry. Returns False if the object was no longer claimed, e.g. the
+    claim expired and another run finished it first
+    """
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+
+    table = dynamodb.Table('processed_objects')
+    try:
+        get_write_scheduler('processed_objects', dynamodb).run(
+            table.update_item,
+            Key={'PK': processed_object},
+            UpdateExpression='SET #s = :done REMOVE #e',
+            ConditionExpression='#s = :processing',
+            ExpressionAttributeNames=OBJECT_STATUS,
+            ExpressionAttributeValues={':done': 'done', ':processing': 'processing'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
 def get_stats_by_date(file_dt, dynamodb):
     if not dynamodb:
         dynamodb = b3.resource('dynamodb', region_name='us-east-1')
@@ -42,7 +383,8 @@ def update_stats_by_month(file_dt, data, dynamodb):
         dynamodb = b3.resource('dynamodb', region_name='us-east-1')
 
     table = dynamodb.Table('stats_by_month')
-    response = table.update_item(
+    response = get_write_scheduler('stats_by_month', dynamodb).run(
+        table.update_item,
         Key={
             'PK': data['PK'],
             'SK': file_dt
@@ -73,6 +415,36 @@ def insert_into_table(table_name, data, dynamodb):
         dynamodb = b3.resource('dynamodb', region_name='us-east-1')
 
     table = dynamodb.Table(table_name)
-    response = table.put_item(Item=data)
+    response = get_write_scheduler(table_name, dynamodb).run(table.put_item, Item=data)
+
+    return response
+
+
+def update_hand_index(item, dynamodb):
+    return insert_into_table('hand_index', item, dynamodb)
+
+
+def get_hand_index(session, dynamodb):
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+
+    table = dynamodb.Table('hand_index')
+    response = table.get_item(Key={'PK': session})
+    return response.get('Item')
+
+
+def update_head_to_head(item, dynamodb):
+    return insert_into_table('head_to_head', item, dynamodb)
+
+
+def get_head_to_head_items(dynamodb):
+    if not dynamodb:
+        dynamodb = b3.resource('dynamodb', region_name='us-east-1')
 
-    return response
\ No newline at end of file
+    table = dynamodb.Table('head_to_head')
+    response = table.scan()
+    items = response['Items']
+    while 'LastEvaluatedKey' in response:
+        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+        items.extend(response['Items'])
+    return items
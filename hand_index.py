@@ -0,0 +1,158 @@
+from array import array
+from boto3.dynamodb.types import Binary
+
+STREETS = ["preflop", "flop", "turn", "river"]
+
+
+def pot_bucket(amount):
+    """
+    Pot sizes are bucketed by powers of two
+    """
+    return max(int(amount), 0).bit_length()
+
+
+def _to_bytes(bitmap):
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+
+class HandIndex:
+    """
+    Inverted index from terms to bitmaps of round numbers (bit n set for round n).
+
+    Terms are tuples:
+        ("action", player, street, action_name)
+        ("3bet", player)
+        ("winner", player)
+        ("shown", player)          player showed their hand
+        ("card", card)             card seen in a shown hand
+        ("combination", card)      card in a winning combination
+        ("pot", bucket)            see pot_bucket
+        ("pot_at_least", amount)   only when querying
+    """
+
+    def __init__(self):
+        self.bitmaps = {}
+        # Round number to total money in round
+        self.pot_sizes = array('i')
+
+    def _add(self, term, number):
+        self.bitmaps[term] = self.bitmaps.get(term, 0) | (1 << number)
+
+    def add_round(self, round):
+        number = round.number
+        for street, moves in zip(STREETS, [round.preflop_moves, round.flop_moves, round.turn_moves,
+                                           round.river_moves]):
+            for move in moves:
+                self._add(("action", move.player, street, move.action_name), number)
+
+        # Same definition of a 3-bet as PreFlopStats
+        open_raise = False
+        for move in round.preflop_moves:
+            if move.action_name == "raise":
+                if not open_raise:
+                    open_raise = True
+                else:
+                    self._add(("3bet", move.player), number)
+                    break
+
+        for player, cards in round.known_hands.items():
+            self._add(("shown", player), number)
+            for card in cards:
+                self._add(("card", card.strip()), number)
+
+        for (player, hand, amt) in round.winners:
+            self._add(("winner", player), number)
+            for card in hand or []:
+                self._add(("combination", card.strip()), number)
+
+        pot_size = round.total_money_in_round()
+        self._add(("pot", pot_bucket(pot_size)), number)
+        if len(self.pot_sizes) <= number:
+            self.pot_sizes.extend([0] * (number + 1 - len(self.pot_sizes)))
+        self.pot_sizes[number] = pot_size
+
+    def merge(self, other):
+        """
+        Add the rounds of another index of the same session, round numbers must not overlap
+        """
+        for term, rounds in other.bitmaps.items():
+            self.bitmaps[term] = self.bitmaps.get(term, 0) | rounds
+        if len(self.pot_sizes) < len(other.pot_sizes):
+            self.pot_sizes.extend([0] * (len(other.pot_sizes) - len(self.pot_sizes)))
+        for number, pot_size in enumerate(other.pot_sizes):
+            if pot_size:
+                self.pot_sizes[number] = pot_size
+        return self
+
+    def pot_at_least(self, amount):
+        bucket = pot_bucket(amount)
+        bitmap = 0
+        for term, rounds in self.bitmaps.items():
+            if term[0] == "pot" and term[1] > bucket:
+                bitmap |= rounds
+        # Pots in the same bucket need an exact check
+        partial = self.bitmaps.get(("pot", bucket), 0)
+        while partial:
+            low = partial & -partial
+            number = low.bit_length() - 1
+            if self.pot_sizes[number] >= amount:
+                bitmap |= low
+            partial ^= low
+        return bitmap
+
+    def bitmap(self, *terms):
+        """
+        Intersection of the given terms, which may also be bitmaps (e.g. from pot_at_least)
+        """
+        result = None
+        for term in terms:
+            if isinstance(term, int):
+                rounds = term
+            elif term[0] == "pot_at_least":
+                rounds = self.pot_at_least(term[1])
+            else:
+                rounds = self.bitmaps.get(term, 0)
+            result = rounds if result is None else result & rounds
+            if not result:
+                return 0
+        return result or 0
+
+    def rounds(self, *terms):
+        bitmap = self.bitmap(*terms)
+        numbers = []
+        while bitmap:
+            low = bitmap & -bitmap
+            numbers.append(low.bit_length() - 1)
+            bitmap ^= low
+        return numbers
+
+    def to_item(self, session):
+        return {
+            'PK': session,
+            'Terms': {"|".join(str(x) for x in term): Binary(_to_bytes(bitmap))
+                      for term, bitmap in self.bitmaps.items()},
+            'Pot_Sizes': Binary(self.pot_sizes.tobytes())
+        }
+
+    @staticmethod
+    def from_item(item):
+        index = HandIndex()
+        for key, value in item['Terms'].items():
+            term = key.split("|")
+            if term[0] == "pot":
+                term[1] = int(term[1])
+            index.bitmaps[tuple(term)] = int.from_bytes(bytes(value), 'little')
+        index.pot_sizes.frombytes(bytes(item['Pot_Sizes']))
+        return index
+
+
+def search_sessions(indexes, *terms):
+    """
+    Round numbers matching all terms for each session in {session: HandIndex}
+    """
+    results = {}
+    for session, index in indexes.items():
+        rounds = index.rounds(*terms)
+        if rounds:
+            results[session] = rounds
+    return results
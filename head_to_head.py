@@ -0,0 +1,115 @@
+from collections import defaultdict
+import numpy as np
+from boto3.dynamodb.types import Binary
+
+
+def pot_flows(spent, won):
+    """
+    (contributor, winner, amount) moved by one round, from player to money put in and player to money
+    collected. The pot is cut into layers by contribution, like side pots: a layer holds what every player
+    who put in at least that much added to it and only goes to winners who also put in that much.
+    Layers are handed out from the top, so a side pot winner is not credited with the main pot as well.
+    """
+    remaining = dict(won)
+    levels = sorted(set(x for x in spent.values() if x > 0))
+    flows = []
+    for n in range(len(levels) - 1, -1, -1):
+        width = levels[n] - (levels[n - 1] if n else 0)
+        contributors = [player for player, amount in spent.items() if amount >= levels[n]]
+        eligible = [player for player in won if spent.get(player, 0) >= levels[n]]
+        weights = [max(remaining[player], 0) for player in eligible]
+        if sum(weights) <= 0:
+            # Winners already credited with everything they collected, split by what they collected
+            weights = [won[player] for player in eligible]
+        total = sum(weights)
+        if total <= 0:
+            continue
+        for winner, weight in zip(eligible, weights):
+            if not weight:
+                continue
+            share = width * weight / total
+            remaining[winner] -= share * len(contributors)
+            flows.extend((contributor, winner, share) for contributor in contributors)
+    return flows
+
+
+class HeadToHead:
+    """
+    flows[i][j] is the money players[i] put into pots that players[j] won, see pot_flows
+    """
+
+    def __init__(self, players, flows):
+        self.players = list(players)
+        self.flows = flows
+        self.player_ids = {player: i for i, player in enumerate(self.players)}
+
+    @staticmethod
+    def from_game(game):
+        player_ids = {}
+        contributors = []
+        winners = []
+        amounts = []
+        for round in game.get_rounds():
+            spent = round.money_spent()
+            won = defaultdict(int)
+            for (player, hand, amt) in round.winners:
+                won[player] += amt
+            for player in list(spent) + list(won):
+                player_ids.setdefault(player, len(player_ids))
+            for contributor, winner, amount in pot_flows(spent, won):
+                contributors.append(player_ids[contributor])
+                winners.append(player_ids[winner])
+                amounts.append(amount)
+
+        flows = np.zeros((len(player_ids), len(player_ids)))
+        np.add.at(flows, (np.array(contributors, dtype=int), np.array(winners, dtype=int)), amounts)
+        # Money won back from yourself is not a flow between players
+        np.fill_diagonal(flows, 0)
+        return HeadToHead(player_ids.keys(), np.rint(flows).astype(np.int64))
+
+    def net(self):
+        """
+        net[i][j] > 0 when players[i] won money from players[j] overall
+        """
+        return self.flows.T - self.flows
+
+    def between(self, player, opponent):
+        """
+        Net money player won from opponent
+        """
+        i = self.player_ids[player]
+        j = self.player_ids[opponent]
+        return int(self.flows[j, i] - self.flows[i, j])
+
+    def __add__(self, other):
+        players = self.players + [x for x in other.players if x not in self.player_ids]
+        flows = np.zeros((len(players), len(players)), dtype=np.int64)
+        mine = np.arange(len(self.players))
+        flows[np.ix_(mine, mine)] += self.flows
+        player_ids = {player: i for i, player in enumerate(players)}
+        theirs = np.array([player_ids[x] for x in other.players], dtype=int)
+        flows[np.ix_(theirs, theirs)] += other.flows
+        return HeadToHead(players, flows)
+
+    def to_item(self, session):
+        return {
+            'PK': session,
+            'Players': self.players,
+            'Flows': Binary(self.flows.astype('<i8').tobytes())
+        }
+
+    @staticmethod
+    def from_item(item):
+        players = list(item['Players'])
+        flows = np.frombuffer(bytes(item['Flows']), dtype='<i8').astype(np.int64)
+        return HeadToHead(players, flows.reshape(len(players), len(players)))
+
+
+def total_head_to_head(items):
+    """
+    Sum persisted per-session matrices (see db.get_head_to_head_items)
+    """
+    total = HeadToHead([], np.zeros((0, 0), dtype=np.int64))
+    for item in items:
+        total = total + HeadToHead.from_item(item)
+    return total
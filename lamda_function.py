@@ -1,10 +1,15 @@
-import itertools
 import re
 from typing import List, Set
 from collections import defaultdict
-from player_stats import WinStats, PlayStats, PreFlopStats, LedgerStats
-from db import get_stats_by_date, get_stats_by_month, insert_into_table, update_stats_by_date, update_stats_by_month
+from stat_registry import LazyStats
+from db import get_stats_by_date, get_stats_by_month, insert_into_table, update_stats_by_date, update_stats_by_month, \
+    claim_object, release_object, processed_object_id, mark_object_processed, bump_stats_version, update_hand_index, \
+    get_write_scheduler, WriteThrottledError, update_stats_columns, update_head_to_head
 from utilities import return_name
+from stack_history import StackHistory
+from hand_index import HandIndex
+from head_to_head import HeadToHead
+from player_timeseries import PlayerTimeseries
 from aggregate_stats import compute_aggregates
 import urllib.parse
 import boto3 as b3
@@ -38,8 +43,11 @@ class Game:
         self.players = {}
         self.players_ledger = {}
         self.players_away_status = {}
+        # Rounds before this game, only set when a log is parsed in chunks
+        self.round_offset = 0
 
-        self.historical_amounts = defaultdict(list)
+        self.stack_history = StackHistory()
+        self.hand_index = HandIndex()
 
     def add_away_player(self, name, away_status):
         correct_name = return_name(name)
@@ -62,14 +70,22 @@ class Game:
         correct_dealer_name = return_name(dealer)
         if len(self.rounds) != 0:
             self._update_amounts()
+            self.hand_index.add_round(self.rounds[-1])
         self._record_amounts()
-        new_round = Round(correct_dealer_name, self.players, len(self.rounds) + 1)
+        new_round = Round(correct_dealer_name, self.players, self.round_offset + len(self.rounds) + 1)
         self.rounds.append(new_round)
         return new_round
 
     def _record_amounts(self):
-        for player, amt in self.players.items():
-            self.historical_amounts[player].append((len(self.rounds), amt))
+        # Under the number of the round about to start
+        self.stack_history.record(self.round_offset + len(self.rounds) + 1, self.players)
+
+    def stack_trajectory(self, player):
+        """
+        Stack changes of a player over the session, as (Round.number, stack at its start), and their
+        max drawdown
+        """
+        return self.stack_history.trajectory(player), self.stack_history.max_drawdown(player)
 
     def _update_amounts(self):
         last_round = self.rounds[-1]
@@ -87,9 +103,12 @@ class Game:
 
     def handle_last_round(self):
         self._update_amounts()
+        self.hand_index.add_round(self.rounds[-1])
         self._record_amounts()
 
     def get_rounds(self):
+        if self.rounds is None:
+            raise ValueError("The rounds of this game were not kept (see parallel_parse)")
         return [x for x in self.rounds if x.total_money_in_round()]
 
 
@@ -209,6 +228,22 @@ class Round:
     #     return s
 
 
+def parse_player_stacks(line):
+    """
+    Player to stack size from a (lowercased) "player stacks:" line
+    """
+    line = line[len("Player stacks: "):]
+    entries = line.split(",")
+    entries = entries[0].split(" | ")
+    stack_sizes = [x.strip().rsplit(' ', 1)[1] for x in entries]
+    # stack_size_counts = [int(x.strip('()')) for x in stack_sizes]
+    stack_size_counts = [int(re.search(r'\d+', x).group()) for x in stack_sizes]
+    players = [return_name(x.split('"')[2].split("@")[0].strip()) for x in entries]
+    # for x in entries:
+    #     print(x.split('"')[2].split("@")[0].strip())
+    return {player: stack_size for (player, stack_size) in zip(players, stack_size_counts)}
+
+
 class Parser:
     def __init__(self, username):
         self.game = Game(username)
@@ -217,7 +252,7 @@ class Parser:
     def _current_round(self):
         return self.game.rounds[-1]
 
-    def parse(self, file_name, username, actual_file) -> Game:
+    def parse(self, file_name, username, actual_file, archive=None) -> Game:
         self.game = Game(username)
         self.username = username
         for line in reversed(actual_file.splitlines()):
@@ -225,6 +260,8 @@ class Parser:
         self.game.handle_last_round()
         game = self.game
         self.game = None
+        if archive is not None:
+            archive.add_session(file_name, game)
         return game
 
     def parse_line(self, line):
@@ -243,16 +280,7 @@ class Parser:
             # print(f"Started hand dealer: {dealer_name}")
             self.game.add_round(dealer_name)
         elif "player stacks:" in line:
-            line = line[len("Player stacks: "):]
-            entries = line.split(",")
-            entries = entries[0].split(" | ")
-            stack_sizes = [x.strip().rsplit(' ', 1)[1] for x in entries]
-            # stack_size_counts = [int(x.strip('()')) for x in stack_sizes]
-            stack_size_counts = [int(re.search(r'\d+', x).group()) for x in stack_sizes]
-            players = [return_name(x.split('"')[2].split("@")[0].strip()) for x in entries]
-            # for x in entries:
-            #     print(x.split('"')[2].split("@")[0].strip())
-            player_amounts = {player: stack_size for (player, stack_size) in zip(players, stack_size_counts)}
+            player_amounts = parse_player_stacks(line)
             for player, amount in player_amounts.items():
                 if amount != self.game.players[player]:
                     round_no = self._current_round.number
@@ -298,17 +326,16 @@ class Parser:
             raise_amount = int(match.group(2))
             self._current_round.add_move(player_name, "raise", raise_amount)
         elif re.search(r'"(.*)" bets (\d+) and go all', line):
-            # TODO: This is the first bet in a round, should be treated differently
+            # First bet of a street, kept apart from raises for postflop stats
             match = re.search(r'"(.*)" bets (\d+) and go all', line)
             player_name = return_name(match.group(1).split("@")[0].strip('" '))
-            raise_amount = int(match.group(2))
-            self._current_round.add_move(player_name, "raise (all in)", raise_amount)
+            bet_amount = int(match.group(2))
+            self._current_round.add_move(player_name, "bet (all in)", bet_amount)
         elif re.search(r'"(.*)" bets (\d+)', line):
-            # TODO: This is the first bet in a round, should be treated differently
             match = re.search(r'"(.*)" bets (\d+)', line)
             player_name = return_name(match.group(1).split("@")[0].strip('" '))
-            raise_amount = int(match.group(2))
-            self._current_round.add_move(player_name, "raise", raise_amount)
+            bet_amount = int(match.group(2))
+            self._current_round.add_move(player_name, "bet", bet_amount)
         elif "uncalled bet" in line:
             for amount, player_name in re.findall(r'uncalled bet of (\d+) returned to "(.*)"', line):
                 self._current_round.add_move(return_name(player_name.split("@")[0].strip('" ')), "uncalled_bet",
@@ -386,41 +413,60 @@ class Parser:
             # print(line)
 
 
-def merge_dict_list(shared_key, *iterables):
-    result = defaultdict(dict)
-    for dictionary in itertools.chain.from_iterable(iterables):
-        result[dictionary[shared_key]].update(dictionary)
-    for dictionary in result.values():
-        dictionary.pop(shared_key)
-    return result
-
-
-def compute_stats(game, file_dt):
-    win_stats = WinStats(game)
-    play_stats = PlayStats(game, win_stats)
-    preflop_stats = PreFlopStats(game, play_stats)
-    ledger_stats = LedgerStats(game)
+def compute_stats(game, file_dt, stats=None, columns=None):
+    """
+    Write the per-player stats of a session to stats_by_date. Rows are plain puts, so writing a session
+    again (e.g. a retried S3 notification) replaces them.
+    stats takes a LazyStats of the game to reuse, or the (WinStats, PlayStats, PreFlopStats, PositionStats,
+    PostFlopStats) returned by parse_parallel.
+    columns limits the work and the write to those stat columns of existing rows (see stat_registry),
+    players without a row for the session are skipped
+    """
+    if not isinstance(stats, LazyStats):
+        families = {}
+        if stats:
+            families = dict(zip(['win_stats', 'play_stats', 'preflop_stats', 'position_stats', 'postflop_stats'],
+                                stats))
+        stats = LazyStats(game, families=families)
     # flop_variance(game)
 
-    ps_data = play_stats.as_dict()
-    ws_data = win_stats.as_dict()
-    pf_data = preflop_stats.as_dict()
-    ls_data = ledger_stats.as_dict()
-    merged_dict = merge_dict_list('Player', ps_data, ws_data, pf_data, ls_data)
-    merged_data = {}
+    merged_dict = stats.columns(columns)
+    rows = []
     file_dt = "/".join(file_dt)
 
     for key, value in merged_dict.items():
-        data = {
+        merged_data = {
             "Player": key,
             "Date_Played": file_dt
             }
-        merged_data.update(data)
         for k, v in value.items():
             v = v.replace(" ", "")
             data = {f"{k}": f"{v}"}
             merged_data.update(data)
-        merge_response = update_stats_by_date(merged_data, None)
+        rows.append(merged_data)
+
+    if columns is not None:
+        missing = []
+
+        def update_columns(player, date_played, data):
+            if not update_stats_columns(player, date_played, data, None):
+                missing.append(player)
+
+        scheduler = get_write_scheduler('stats_by_date', None)
+        for merged_data in rows:
+            scheduler.submit(update_columns, merged_data.pop("Player"), merged_data.pop("Date_Played"), merged_data)
+        scheduler.flush()
+        if missing:
+            print(f"No stats_by_date rows on {file_dt} for {', '.join(missing)}, skipped")
+        bump_stats_version(None)
+        return True
+
+    scheduler = get_write_scheduler('stats_by_date', None)
+    for merged_data in rows:
+        scheduler.submit(update_stats_by_date, merged_data, None)
+    scheduler.flush()
+    bump_stats_version(None)
+    return True
 
 
 def lambda_handler(event, context):
@@ -431,16 +477,45 @@ def lambda_handler(event, context):
     print(bucket)
     key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
     print(key)
+    claimed = False
     try:
+        # S3 delivers notifications at least once, skip objects that were processed or are being processed.
+        # The claim lasts as long as this invocation can run, a retry after a timeout can claim it again
+        etag = event['Records'][0]['s3']['object'].get('eTag')
+        if not etag:
+            etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+        processed_object = processed_object_id(bucket, key, etag)
+        lease = context.get_remaining_time_in_millis() / 1000 if context else 900
+        if not claim_object(processed_object, lease, None):
+            print(f"Skipping already processed object {processed_object}")
+            return
+        claimed = True
+
         response = s3.get_object(Bucket=bucket, Key=key)
         print("CONTENT TYPE: " + response['ContentType'])
         p = Parser("")
         file_dt = re.findall(r'\d+', key)
         contents=response['Body'].read().decode(encoding="utf-8",errors="ignore")
         game = p.parse(key, '', contents)
-        compute_stats(game, file_dt)
+        stats = LazyStats(game)
+        compute_stats(game, file_dt, stats)
+        update_hand_index(game.hand_index.to_item("/".join(file_dt)), None)
+        update_head_to_head(HeadToHead.from_game(game).to_item("/".join(file_dt)), None)
+        PlayerTimeseries().record_game(game, file_dt, stats)
         #compute_aggregates(file_dt)
+        # Marked last, so if any write above fails the retried notification redoes all of them
+        # (each one replaces what an earlier attempt wrote)
+        if not mark_object_processed(processed_object, None):
+            print(f"Claim on {processed_object} expired before it was processed, another run may have written it too")
+    except WriteThrottledError as e:
+        print(e)
+        print('DynamoDB kept throttling writes for object {} from bucket {}. Check the table capacity.'.format(key, bucket))
+        if claimed:
+            release_object(processed_object, None)
+        raise e
     except Exception as e:
         print(e)
+        if claimed:
+            release_object(processed_object, None)
         print('Error getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket))
         raise e
\ No newline at end of file
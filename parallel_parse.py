@@ -0,0 +1,150 @@
+"""
+Parsing one large log in worker processes, for backfills and local runs. lambda_handler does not use it,
+Lambda has no /dev/shm for the process pool to work with.
+
+Rounds stay in the workers, the merged Game has rounds None so anything reading them raises instead of
+seeing an empty session. Its head to head matrix is summed from the chunks instead.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from lamda_function import Game, Parser, parse_player_stacks
+from head_to_head import HeadToHead
+from player_stats import WinStats, PlayStats, PreFlopStats, PositionStats, PostFlopStats
+from utilities import return_name
+
+
+class ChunkGame(Game):
+    """
+    Game for a slice of a log. Joins and stand ups are recorded so the ledger can be replayed across chunks
+    """
+
+    def __init__(self, username, round_offset):
+        super().__init__(username)
+        self.round_offset = round_offset
+        # ("join", name, amount, stack at that point or None) or ("away", name, away_status)
+        self.ledger_events = []
+        self.head_to_head = None
+
+    def seed(self, player_amounts):
+        for player, amount in player_amounts.items():
+            self.players[player] = amount
+            self.players_ledger[player] = 0
+            self.players_away_status[player] = False
+
+    def add_away_player(self, name, away_status):
+        self.ledger_events.append(("away", return_name(name), away_status))
+        super().add_away_player(name, away_status)
+
+    def add_player(self, name, amount):
+        correct_name = return_name(name)
+        self.ledger_events.append(("join", correct_name, amount, self.players.get(correct_name)))
+        super().add_player(name, amount)
+
+
+def split_log(actual_file, chunks):
+    """
+    Split a log into up to chunks lists of lines in playing order, each starting at a "-- starting hand" line
+    (except the first, which also holds everything before the first hand). Returns (round offset, lines) pairs
+    """
+    lines = list(reversed(actual_file.splitlines()))
+    starts = [i for i, line in enumerate(lines) if "-- starting hand" in line.lower()]
+    if not starts:
+        return [(0, lines)]
+
+    per_chunk = max(1, -(-len(starts) // chunks))
+    boundaries = starts[::per_chunk]
+    boundaries[0] = 0
+    result = []
+    for n, start in enumerate(boundaries):
+        end = boundaries[n + 1] if n + 1 < len(boundaries) else len(lines)
+        result.append((n * per_chunk, lines[start:end]))
+    return result
+
+
+def _parse_chunk(args):
+    username, round_offset, lines = args
+    parser = Parser(username)
+    game = ChunkGame(username, round_offset)
+    if round_offset:
+        # Start from the stacks logged at the start of the chunk's first hand
+        for line in lines:
+            line = line.replace('.', '').lower()
+            if "player stacks:" in line:
+                game.seed(parse_player_stacks(line))
+                break
+    parser.game = game
+    for line in lines:
+        parser.parse_line(line)
+    game.handle_last_round()
+
+    win_stats = WinStats(game)
+    play_stats = PlayStats(game, win_stats)
+    preflop_stats = PreFlopStats(game, play_stats)
+    position_stats = PositionStats(game)
+    postflop_stats = PostFlopStats(game)
+    stats = (win_stats, play_stats, preflop_stats, position_stats, postflop_stats)
+
+    # Rounds stay in the worker, only counters, the ledger and the compact histories are sent back
+    game.head_to_head = HeadToHead.from_game(game)
+    game.rounds = []
+    position_stats.round_positions = {}
+    for stat in stats:
+        stat.evening = None
+    return game, stats
+
+
+def _merge_games(username, games):
+    game = Game(username)
+    game.rounds = None
+    game.head_to_head = HeadToHead([], np.zeros((0, 0), dtype=np.int64))
+    for chunk in games:
+        game.head_to_head = game.head_to_head + chunk.head_to_head
+        game.stack_history.merge(chunk.stack_history)
+        game.hand_index.merge(chunk.hand_index)
+
+        if not chunk.round_offset:
+            game.players.update(chunk.players)
+            game.players_ledger.update(chunk.players_ledger)
+            game.players_away_status.update(chunk.players_away_status)
+            continue
+
+        # Same rules as Game.add_player, against the stacks the chunk had when the player joined
+        for event in chunk.ledger_events:
+            if event[0] == "away":
+                game.players_away_status[event[1]] = event[2]
+                continue
+            _, name, amount, stack = event
+            if name in game.players:
+                if game.players_away_status[name]:
+                    game.players_away_status[name] = False
+                elif amount != 0 and amount != (stack if stack is not None else game.players[name]):
+                    game.players_ledger[name] += amount
+            else:
+                game.players[name] = amount
+                game.players_ledger[name] = amount
+                game.players_away_status[name] = False
+        game.players.update(chunk.players)
+    return game
+
+
+def parse_parallel(username, actual_file, workers=None):
+    """
+    Parse one log in worker processes, split at hand boundaries. Returns the merged Game and its
+    (WinStats, PlayStats, PreFlopStats, PositionStats, PostFlopStats), equal to parsing and computing them serially.
+    The Game has the players, ledger, stack history, hand index and head_to_head but its rounds are None,
+    pass the stats on instead (compute_stats(game, file_dt, stats))
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = split_log(actual_file, workers)
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        results = list(executor.map(_parse_chunk, [(username, offset, lines) for offset, lines in chunks]))
+
+    game = _merge_games(username, [chunk_game for chunk_game, _ in results])
+    stats = results[0][1]
+    for _, chunk_stats in results[1:]:
+        for merged, partial in zip(stats, chunk_stats):
+            merged.merge(partial)
+    for merged in stats:
+        merged.evening = game
+    return game, stats
@@ -1,3 +1,4 @@
+from array import array
 from collections import defaultdict
 from utilities import avg, safe_div, median
 
@@ -52,6 +53,16 @@ class WinStats:
         self.showdown_wins = showdown_wins
         self.preshowdown_wins = preshowdown_wins
 
+    def merge(self, other):
+        """
+        Add the rounds of other (a later part of the same evening) to these stats
+        """
+        for mine, theirs in [(self.wins, other.wins), (self.showdown_wins, other.showdown_wins),
+                             (self.preshowdown_wins, other.preshowdown_wins)]:
+            for player, amts in theirs.items():
+                mine[player].extend(amts)
+        return self
+
     def as_dict(self):
         showdown_wins = self.showdown_wins
         preshowdown_wins = self.preshowdown_wins
@@ -82,13 +93,15 @@ class WinStats:
 
 
 class PlayStats:
-    def __init__(self, evening, win_stats: WinStats):
+    def __init__(self, evening, win_stats: WinStats = None):
+        # Without win_stats as_dict leaves out the columns built from wins
         self.evening = evening
         self.win_stats = win_stats
         rounds_present = defaultdict(int)
         rounds_contributed = defaultdict(int)
         showdowns_played = defaultdict(int)
-        for round in evening.get_rounds():
+        rounds = evening.get_rounds()
+        for round in rounds:
             for player in round.names_in_showdown():
                 showdowns_played[player] += 1
 
@@ -101,6 +114,16 @@ class PlayStats:
         self.rounds_present = rounds_present
         self.rounds_contributed = rounds_contributed
         self.showdowns_played = showdowns_played
+        self.num_rounds = len(rounds)
+
+    def merge(self, other):
+        self.num_rounds += other.num_rounds
+        for mine, theirs in [(self.rounds_present, other.rounds_present),
+                             (self.rounds_contributed, other.rounds_contributed),
+                             (self.showdowns_played, other.showdowns_played)]:
+            for player, count in theirs.items():
+                mine[player] += count
+        return self
 
     def as_dict(self):
         # % How often you saw each stage
@@ -109,26 +132,26 @@ class PlayStats:
         # Define dictionary containing the players
         playstats_data = []
 
-        max_rounds = len(self.evening.get_rounds())
+        max_rounds = self.num_rounds
         print(f"Rounds: {max_rounds}")
         for player in self.evening.players.keys():
             total_rounds = self.rounds_present[player]
-            player_wins = len(self.win_stats.wins[player])
-            player_showdown_wins = len(self.win_stats.showdown_wins[player])
             pct_played = safe_div(self.rounds_contributed[player], total_rounds) * 100
-            pct_played_wins = safe_div(player_wins, self.rounds_contributed[player]) * 100
-            pct_showdown_wins = safe_div(player_showdown_wins, self.showdowns_played[player]) * 100
 
             data = {'Player': player,
                     # 'Date_Played': file_dt,
-                    'Rounds_Won': f"{player_wins:>3d}",
                     'Rounds_Played': f"{self.rounds_contributed[player]:>3d}",
                     'Total_Rounds': f"{total_rounds:>3d}",
-                    'Showdowns_Won': f"{player_showdown_wins:>3d}",
                     'Showdowns_Faced': f"{self.showdowns_played[player]:>3d}",
-                    'VPIP_Percentage':  f"{pct_played:>6.2f}%",
-                    'Win_Percentage': f"{pct_played_wins:>6.2f}%"
+                    'VPIP_Percentage':  f"{pct_played:>6.2f}%"
                     }
+            if self.win_stats:
+                player_wins = len(self.win_stats.wins[player])
+                player_showdown_wins = len(self.win_stats.showdown_wins[player])
+                pct_played_wins = safe_div(player_wins, self.rounds_contributed[player]) * 100
+                data.update({'Rounds_Won': f"{player_wins:>3d}",
+                             'Showdowns_Won': f"{player_showdown_wins:>3d}",
+                             'Win_Percentage': f"{pct_played_wins:>6.2f}%"})
             playstats_data.append(data)
 
         return playstats_data
@@ -151,7 +174,7 @@ class PreFlopStats:
             preflop_amounts = round.money_in_round(round.preflop_moves)
             for player, amt in preflop_amounts.items():
                 if amt == round.big_blind[1] and 0 == len(round.find_moves(player, "fold", round.preflop_moves)):
-                    limp_rounds[player].append(round)
+                    limp_rounds[player].append(round.number)
 
             # In case there are multiple raises in a single round
             round_raises = {}
@@ -169,11 +192,11 @@ class PreFlopStats:
 
             for player, amt in round_raises.items():
                 raise_amts[player].append(amt)
-                raise_rounds[player].append(round)
+                raise_rounds[player].append(round.number)
 
             for player, amt in round_3bets.items():
                 three_bet_amts[player].append(amt)
-                three_bet_rounds[player].append(round)
+                three_bet_rounds[player].append(round.number)
 
         self.limp_rounds = limp_rounds
         self.raise_amts = raise_amts
@@ -181,6 +204,14 @@ class PreFlopStats:
         self.three_bet_amts = three_bet_amts
         self.three_bet_rounds = three_bet_rounds
 
+    def merge(self, other):
+        for mine, theirs in [(self.limp_rounds, other.limp_rounds), (self.raise_amts, other.raise_amts),
+                             (self.raise_rounds, other.raise_rounds), (self.three_bet_amts, other.three_bet_amts),
+                             (self.three_bet_rounds, other.three_bet_rounds)]:
+            for player, values in theirs.items():
+                mine[player].extend(values)
+        return self
+
     def as_dict(self):
         # Define dictionary containing the players
         playstats_data = []
@@ -207,6 +238,240 @@ class PreFlopStats:
         return playstats_data
 
 
+POSITIONS = ["BTN", "SB", "BB", "EP", "MP", "LP"]
+BLINDS = ["small_blind", "big_blind", "missing_big_blind", "missing_small_blind"]
+
+
+def _position_counts():
+    return array('i', [0] * len(POSITIONS))
+
+
+def seat_positions(round):
+    """
+    Players of a round in preflop seat order (small blind first) and their index into POSITIONS
+    """
+    small_blind = None
+    big_blind = None
+    others = []
+    seen = set()
+    for m in round.preflop_moves:
+        if m.action_name == "small_blind" and small_blind is None:
+            small_blind = m.player
+        elif m.action_name == "big_blind" and big_blind is None:
+            big_blind = m.player
+        elif m.player not in seen and m.player not in (small_blind, big_blind):
+            others.append(m.player)
+        seen.add(m.player)
+
+    # Either blind can be missing, e.g. a dead small blind
+    players = []
+    codes = array('B')
+    if small_blind is not None:
+        players.append(small_blind)
+        codes.append(POSITIONS.index("SB"))
+    if big_blind is not None:
+        players.append(big_blind)
+        codes.append(POSITIONS.index("BB"))
+    if others and others[-1] == round.dealer:
+        button = others.pop()
+    else:
+        button = None
+
+    # Everyone between the big blind and the button, split in thirds
+    n = len(others)
+    for i, player in enumerate(others):
+        players.append(player)
+        if i < n // 3:
+            codes.append(POSITIONS.index("EP"))
+        elif i < 2 * n // 3:
+            codes.append(POSITIONS.index("MP"))
+        else:
+            codes.append(POSITIONS.index("LP"))
+    if button is not None:
+        players.append(button)
+        codes.append(POSITIONS.index("BTN"))
+    return tuple(players), codes
+
+
+class PositionStats:
+    def __init__(self, evening):
+        # Seat order and position of every player, computed once per round
+        self.evening = evening
+        self.round_positions = {}
+        rounds_present = defaultdict(_position_counts)
+        rounds_contributed = defaultdict(_position_counts)
+        rounds_raised = defaultdict(_position_counts)
+        rounds_won = defaultdict(_position_counts)
+
+        for round in evening.get_rounds():
+            players, codes = seat_positions(round)
+            self.round_positions[round.number] = (players, codes)
+            position = dict(zip(players, codes))
+
+            contributed = set()
+            raised = set()
+            for m in round.preflop_moves:
+                if m.action_name not in BLINDS and m.amount > 0:
+                    contributed.add(m.player)
+                if m.action_name == "raise":
+                    raised.add(m.player)
+            winners = {player for (player, hand, amt) in round.winners}
+
+            for player, code in position.items():
+                rounds_present[player][code] += 1
+                if player in contributed:
+                    rounds_contributed[player][code] += 1
+                if player in raised:
+                    rounds_raised[player][code] += 1
+                if player in winners:
+                    rounds_won[player][code] += 1
+
+        self.rounds_present = rounds_present
+        self.rounds_contributed = rounds_contributed
+        self.rounds_raised = rounds_raised
+        self.rounds_won = rounds_won
+
+    def merge(self, other):
+        self.round_positions.update(other.round_positions)
+        for mine, theirs in [(self.rounds_present, other.rounds_present),
+                             (self.rounds_contributed, other.rounds_contributed),
+                             (self.rounds_raised, other.rounds_raised), (self.rounds_won, other.rounds_won)]:
+            for player, counts in theirs.items():
+                for code, count in enumerate(counts):
+                    mine[player][code] += count
+        return self
+
+    def as_dict(self):
+        positionstats_data = []
+
+        for player in self.evening.players.keys():
+            data = {'Player': player}
+            for code, position in enumerate(POSITIONS):
+                total_rounds = self.rounds_present[player][code]
+                rounds_played = self.rounds_contributed[player][code]
+                pct_played = safe_div(rounds_played, total_rounds) * 100
+                pct_raised = safe_div(self.rounds_raised[player][code], total_rounds) * 100
+                pct_played_wins = safe_div(self.rounds_won[player][code], rounds_played) * 100
+                data.update({f'{position}_Total_Rounds': f"{total_rounds:>3d}",
+                             f'{position}_VPIP_Percentage': f"{pct_played:>6.2f}%",
+                             f'{position}_PFR_Percentage': f"{pct_raised:>6.2f}%",
+                             f'{position}_Win_Percentage': f"{pct_played_wins:>6.2f}%"
+                             })
+            positionstats_data.append(data)
+
+        return positionstats_data
+
+
+AGGRESSIVE = ["bet", "bet (all in)", "raise", "raise (all in)"]
+CALLS = ["call", "call (all in)"]
+
+
+class PostFlopStats:
+    def __init__(self, evening):
+        # Continuation bets, folds to them, aggression factor and going to showdown, walking every
+        # move of a round once
+        self.evening = evening
+        saw_flop = defaultdict(int)
+        went_to_showdown = defaultdict(int)
+        cbet_opportunities = defaultdict(int)
+        cbets = defaultdict(int)
+        faced_cbet = defaultdict(int)
+        folded_to_cbet = defaultdict(int)
+        aggressive_actions = defaultdict(int)
+        calls = defaultdict(int)
+
+        for round in evening.get_rounds():
+            # Preflop aggressor is the last player to raise
+            aggressor = None
+            folded = set()
+            present = []
+            for move in round.preflop_moves:
+                if move.player not in present:
+                    present.append(move.player)
+                if move.action_name in AGGRESSIVE:
+                    aggressor = move.player
+                elif move.action_name == "fold":
+                    folded.add(move.player)
+
+            if round.flop is None:
+                continue
+            in_hand = [x for x in present if x not in folded]
+            for player in in_hand:
+                saw_flop[player] += 1
+
+            for street, moves in enumerate([round.flop_moves, round.turn_moves, round.river_moves]):
+                bet_made = False
+                # A c-bet is live until someone raises it
+                cbet_live = False
+                responded = set()
+                for move in moves:
+                    action = move.action_name
+                    if street == 0 and move.player == aggressor and aggressor not in responded and \
+                            not bet_made and action not in ["show", "uncalled_bet"]:
+                        cbet_opportunities[aggressor] += 1
+                        responded.add(aggressor)
+                        if action in AGGRESSIVE:
+                            cbets[aggressor] += 1
+                            cbet_live = True
+                    elif cbet_live and move.player not in responded and action in AGGRESSIVE + CALLS + ["fold"]:
+                        responded.add(move.player)
+                        faced_cbet[move.player] += 1
+                        if action == "fold":
+                            folded_to_cbet[move.player] += 1
+
+                    if action in AGGRESSIVE:
+                        if bet_made:
+                            cbet_live = False
+                        bet_made = True
+                        aggressive_actions[move.player] += 1
+                    elif action in CALLS:
+                        calls[move.player] += 1
+                    elif action == "fold":
+                        folded.add(move.player)
+
+            in_hand = [x for x in in_hand if x not in folded]
+            if len(in_hand) > 1:
+                for player in in_hand:
+                    went_to_showdown[player] += 1
+
+        self.saw_flop = saw_flop
+        self.went_to_showdown = went_to_showdown
+        self.cbet_opportunities = cbet_opportunities
+        self.cbets = cbets
+        self.faced_cbet = faced_cbet
+        self.folded_to_cbet = folded_to_cbet
+        self.aggressive_actions = aggressive_actions
+        self.calls = calls
+
+    def merge(self, other):
+        for name in ["saw_flop", "went_to_showdown", "cbet_opportunities", "cbets", "faced_cbet", "folded_to_cbet",
+                     "aggressive_actions", "calls"]:
+            mine = getattr(self, name)
+            for player, count in getattr(other, name).items():
+                mine[player] += count
+        return self
+
+    def as_dict(self):
+        postflopstats_data = []
+
+        for player in self.evening.players.keys():
+            pct_cbet = safe_div(self.cbets[player], self.cbet_opportunities[player]) * 100
+            pct_fold_to_cbet = safe_div(self.folded_to_cbet[player], self.faced_cbet[player]) * 100
+            aggression_factor = safe_div(self.aggressive_actions[player], self.calls[player])
+            pct_showdown = safe_div(self.went_to_showdown[player], self.saw_flop[player]) * 100
+
+            data = {'Player': player,
+                    'Saw_Flop': f"{self.saw_flop[player]:>3d}",
+                    'CBet_Percentage': f"{pct_cbet:>6.2f}%",
+                    'Fold_To_CBet_Percentage': f"{pct_fold_to_cbet:>6.2f}%",
+                    'Aggression_Factor': f"{aggression_factor:>5.2f}",
+                    'WTSD_Percentage': f"{pct_showdown:>6.2f}%"
+                    }
+            postflopstats_data.append(data)
+
+        return postflopstats_data
+
+
 def fold_stats():
     # What amount causes a person to fold (absolute) vs (relative to pot)
     pass
@@ -0,0 +1,191 @@
+"""
+Per-player session counters with running totals, in the player_timeseries table:
+
+    PK  player
+    SK  D#<session date key>    one item per session, for date ranges (see session_sort_key)
+        N#<session number>      the same item again, for "last n sessions"
+        VERSION                 bumped by every write of the player's items
+
+Every item holds the session's raw counters and the player's cumulative counters up to and including it,
+so any window is the difference between the cumulative counters of two items.
+"""
+import boto3 as b3
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+from db import get_write_scheduler
+from stat_registry import LazyStats
+from utilities import safe_div
+
+TABLE = 'player_timeseries'
+VERSION_KEY = 'VERSION'
+COUNTERS = ['Sessions', 'Total_Rounds', 'Rounds_Played', 'Rounds_Won', 'Showdowns_Won', 'Showdowns_Faced',
+            'Rounds_Raised', 'Rounds_Limped', 'BuyIn', 'Profit_Loss']
+
+
+def session_sort_key(file_dt):
+    """
+    Date parts of an S3 key (see lambda_handler) year first and zero padded, so keys sort as strings
+    """
+    parts = list(file_dt)
+    if len(parts) >= 3 and len(parts[2]) == 4 and len(parts[0]) != 4:
+        # month/day/year
+        parts = [parts[2], parts[0], parts[1]] + parts[3:]
+    return "/".join(x.zfill(2) for x in parts)
+
+
+def session_counters(game, stats=None):
+    """
+    Player to raw counters of one session, money in chips. stats is the LazyStats the session's stats
+    were computed with, so the families are not built again
+    """
+    stats = stats or LazyStats(game)
+    win_stats = stats.family('win_stats')
+    play_stats = stats.family('play_stats')
+    preflop_stats = stats.family('preflop_stats')
+    counters = {}
+    for player in game.players.keys():
+        counters[player] = {
+            'Sessions': 1,
+            'Total_Rounds': play_stats.rounds_present[player],
+            'Rounds_Played': play_stats.rounds_contributed[player],
+            'Rounds_Won': len(win_stats.wins[player]),
+            'Showdowns_Won': len(win_stats.showdown_wins[player]),
+            'Showdowns_Faced': play_stats.showdowns_played[player],
+            'Rounds_Raised': len(preflop_stats.raise_rounds[player]),
+            'Rounds_Limped': len(preflop_stats.limp_rounds[player]),
+            'BuyIn': game.players_ledger[player],
+            'Profit_Loss': game.players[player] - game.players_ledger[player]
+        }
+    return counters
+
+
+def _counters(item, name='Cumulative'):
+    if not item:
+        return {x: 0 for x in COUNTERS}
+    return {x: int(item[name].get(x, 0)) for x in COUNTERS}
+
+
+def _window(end, start):
+    end = _counters(end)
+    start = _counters(start)
+    window = {x: end[x] - start[x] for x in COUNTERS}
+    window['VPIP_Percentage'] = safe_div(window['Rounds_Played'], window['Total_Rounds']) * 100
+    window['PFR_Percentage'] = safe_div(window['Rounds_Raised'], window['Total_Rounds']) * 100
+    window['Win_Percentage'] = safe_div(window['Rounds_Won'], window['Rounds_Played']) * 100
+    return window
+
+
+def _seq_key(seq):
+    return f"N#{seq:08d}"
+
+
+def _is_conflict(error):
+    if error.response['Error']['Code'] != 'TransactionCanceledException':
+        return False
+    reasons = error.response.get('CancellationReasons', [])
+    return any(x.get('Code') in ['ConditionalCheckFailed', 'TransactionConflict'] for x in reasons)
+
+
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+class PlayerTimeseries:
+    def __init__(self, dynamodb=None):
+        if not dynamodb:
+            dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+        self.dynamodb = dynamodb
+        self.table = dynamodb.Table(TABLE)
+
+    def _last(self, condition, consistent=False):
+        response = self.table.query(KeyConditionExpression=condition, ScanIndexForward=False, Limit=1,
+                                    ConsistentRead=consistent)
+        items = response.get('Items', [])
+        return items[0] if items else None
+
+    def _last_before(self, player, date_key, consistent=False):
+        # N# and VERSION items sort after every D# item, so only sessions can match
+        return self._last(Key('PK').eq(player) & Key('SK').lt(f"D#{date_key}"), consistent)
+
+    def _version(self, player):
+        response = self.table.get_item(Key={'PK': player, 'SK': VERSION_KEY}, ConsistentRead=True)
+        return int(response.get('Item', {}).get('Version', 0))
+
+    def record_session(self, player, date_key, date_played, counters, max_retries=5):
+        """
+        Store a session (replacing it if it was stored before) and fix the running totals of later sessions.
+        Starts over from fresh reads when another writer changed the player's items meanwhile
+        """
+        for attempt in range(max_retries + 1):
+            try:
+                self._record_session(player, date_key, date_played, counters)
+                return
+            except ClientError as e:
+                if not _is_conflict(e):
+                    raise
+        raise ConcurrentUpdateError(f"Timeseries of {player} still changing after {max_retries} retries")
+
+    def _record_session(self, player, date_key, date_played, counters):
+        # Read before the items, every write below fails if it changed since
+        version = self._version(player)
+        previous = self._last_before(player, date_key, consistent=True)
+        seq = int(previous['Seq']) if previous else 0
+        cumulative = _counters(previous)
+
+        # Sessions after this one, only when backfilling or reprocessing
+        condition = Key('PK').eq(player) & Key('SK').between(f"D#{date_key}", "D#\uffff")
+        response = self.table.query(KeyConditionExpression=condition, ConsistentRead=True)
+        later = response.get('Items', [])
+        while 'LastEvaluatedKey' in response:
+            response = self.table.query(KeyConditionExpression=condition, ConsistentRead=True,
+                                        ExclusiveStartKey=response['LastEvaluatedKey'])
+            later.extend(response.get('Items', []))
+        later = [x for x in later if x['SK'] != f"D#{date_key}"]
+
+        sessions = [(date_key, date_played, counters)]
+        sessions += [(x['SK'][2:], x['Date_Played'], _counters(x, 'Session')) for x in later]
+        scheduler = get_write_scheduler(TABLE, self.dynamodb)
+        for session_key, session_date, session in sessions:
+            seq += 1
+            cumulative = {x: cumulative[x] + session[x] for x in COUNTERS}
+            item = {'PK': player, 'Seq': seq, 'Date_Played': session_date, 'Session': session,
+                    'Cumulative': cumulative}
+            # Both items of a session together, each step moving the version on by one
+            scheduler.run(self.dynamodb.meta.client.transact_write_items, TransactItems=[
+                {'Put': {'TableName': TABLE, 'Item': dict(item, SK=f"D#{session_key}")}},
+                {'Put': {'TableName': TABLE, 'Item': dict(item, SK=_seq_key(seq))}},
+                {'Update': {'TableName': TABLE,
+                            'Key': {'PK': player, 'SK': VERSION_KEY},
+                            'UpdateExpression': 'SET Version = :next',
+                            'ConditionExpression': 'attribute_not_exists(Version) OR Version = :version',
+                            'ExpressionAttributeValues': {':version': version, ':next': version + 1}}}
+            ])
+            version += 1
+
+    def record_game(self, game, file_dt, stats=None):
+        date_key = session_sort_key(file_dt)
+        for player, counters in session_counters(game, stats).items():
+            self.record_session(player, date_key, "/".join(file_dt), counters)
+
+    def last_sessions(self, player, n):
+        """
+        Totals over the player's last n sessions
+        """
+        latest = self._last(Key('PK').eq(player) & Key('SK').begins_with("N#"))
+        if not latest or int(latest['Seq']) <= n:
+            return _window(latest, None)
+        start = self.table.get_item(Key={'PK': player, 'SK': _seq_key(int(latest['Seq']) - n)}).get('Item')
+        return _window(latest, start)
+
+    def date_range(self, player, start, end):
+        """
+        Totals over sessions with start <= date key < end. Prefixes work, e.g. ("2021/01", "2021/02")
+        """
+        return _window(self._last_before(player, end), self._last_before(player, start))
+
+    def trend(self, player, boundaries):
+        """
+        Totals between consecutive date keys, e.g. the start of every week
+        """
+        points = [self._last_before(player, x) for x in boundaries]
+        return [_window(end, start) for start, end in zip(points, points[1:])]
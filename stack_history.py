@@ -0,0 +1,93 @@
+from array import array
+from bisect import bisect_right
+
+
+class StackHistory:
+    """
+    Per-player stack sizes over a session, stored as change points.
+
+    A player's stack is only written when it differs from the last recorded value,
+    so a player sitting out (or folding preflop without posting) costs nothing.
+
+    Rounds are keyed by Round.number (1 based, like HandIndex and the archive): the stacks recorded
+    under n are the stacks at the start of round n, the final stacks are under the last number + 1.
+    """
+
+    def __init__(self):
+        # Player to round numbers at which the stack changed
+        self.rounds = {}
+        # Player to stack amount starting at the matching round number
+        self.amounts = {}
+
+    def record(self, number, players):
+        for player, amt in players.items():
+            rounds = self.rounds.get(player)
+            if rounds is None:
+                self.rounds[player] = array('i', [number])
+                self.amounts[player] = array('i', [amt])
+            elif self.amounts[player][-1] != amt:
+                if rounds[-1] == number:
+                    # Stack was corrected before the round started
+                    self.amounts[player][-1] = amt
+                else:
+                    rounds.append(number)
+                    self.amounts[player].append(amt)
+
+    def merge(self, other):
+        """
+        Append the history of a later part of the session. Where both have the same round number, the
+        earlier history wins
+        """
+        for player, rounds in other.rounds.items():
+            amounts = other.amounts[player]
+            for number, amt in zip(rounds, amounts):
+                mine = self.rounds.get(player)
+                if mine is not None and mine[-1] >= number:
+                    continue
+                self.record(number, {player: amt})
+        return self
+
+    def players(self):
+        return list(self.rounds.keys())
+
+    def stack_at(self, player, number):
+        """
+        Stack of a player at the start of the round with Round.number number (None if they hadn't joined yet)
+        """
+        rounds = self.rounds.get(player)
+        if rounds is None:
+            return None
+        pos = bisect_right(rounds, number) - 1
+        if pos < 0:
+            return None
+        return self.amounts[player][pos]
+
+    def deltas(self, player):
+        """
+        (round number, change in stack) for every round where the stack changed
+        """
+        rounds = self.rounds.get(player, ())
+        amounts = self.amounts.get(player, ())
+        prev = 0
+        for number, amt in zip(rounds, amounts):
+            yield number, amt - prev
+            prev = amt
+
+    def trajectory(self, player):
+        """
+        (round number, stack) for every round where the stack changed
+        """
+        return list(zip(self.rounds.get(player, ()), self.amounts.get(player, ())))
+
+    def max_drawdown(self, player):
+        """
+        Largest drop in stack from a previous peak
+        """
+        peak = None
+        drawdown = 0
+        for amt in self.amounts.get(player, ()):
+            if peak is None or amt > peak:
+                peak = amt
+            elif peak - amt > drawdown:
+                drawdown = peak - amt
+        return drawdown
@@ -0,0 +1,115 @@
+from collections import defaultdict
+from player_stats import WinStats, PlayStats, PreFlopStats, LedgerStats, PositionStats, PostFlopStats, POSITIONS
+
+
+class StatRegistry:
+    """
+    Stat families (the classes in player_stats), the families each one is built from, the columns
+    its as_dict() produces and the extra families single columns need
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.column_families = {}
+
+    def register(self, name, build, dependencies=(), columns=(), inputs=None):
+        """
+        build is called with the game followed by the built dependencies, in order. inputs maps a column
+        to families only that column needs, passed as keyword arguments when one of those columns is asked for
+        """
+        inputs = {column: tuple(families) for column, families in (inputs or {}).items()}
+        self.families[name] = (build, tuple(dependencies), tuple(columns), inputs)
+        for column in columns:
+            self.column_families[column] = name
+
+    def families_for(self, columns=None):
+        """
+        Family to the inputs it needs for the given columns (all of them for None)
+        """
+        if columns is None:
+            return {name: self.inputs_for(name) for name in self.families}
+        families = {}
+        for column in columns:
+            if column not in self.column_families:
+                raise KeyError(f"Unknown stat column {column}")
+            name = self.column_families[column]
+            families[name] = families.get(name, set()) | self.inputs_for(name, [column])
+        return families
+
+    def inputs_for(self, name, columns=None):
+        inputs = self.families[name][3]
+        if columns is None:
+            columns = inputs.keys()
+        return {family for column in columns for family in inputs.get(column, ())}
+
+
+REGISTRY = StatRegistry()
+REGISTRY.register('win_stats', WinStats,
+                  columns=['Rounds_Won', 'Median_Win_Amt', 'Showdown_Win_Percentage', 'Median_Showdown_Amt',
+                           'Pre_Showdown_Win_Percentage', 'Median_Preshowdown_Amt'])
+REGISTRY.register('play_stats', PlayStats,
+                  columns=['Rounds_Played', 'Total_Rounds', 'Showdowns_Won', 'Showdowns_Faced', 'VPIP_Percentage',
+                           'Win_Percentage'],
+                  inputs={'Showdowns_Won': ['win_stats'], 'Win_Percentage': ['win_stats']})
+REGISTRY.register('preflop_stats', PreFlopStats, dependencies=['play_stats'],
+                  columns=['Avg_Raise_Amount', 'Avg_3_Bet_Amount', 'Rounds_Raised', 'PFR_Percentage',
+                           'Rounds_Limped', 'Limped_Percentage'])
+REGISTRY.register('ledger_stats', LedgerStats,
+                  columns=['BuyIn', 'BuyOut', 'Profit_Loss', 'Profit_Loss_Percentage'])
+REGISTRY.register('position_stats', PositionStats,
+                  columns=[f"{position}_{column}" for position in POSITIONS
+                           for column in ['Total_Rounds', 'VPIP_Percentage', 'PFR_Percentage', 'Win_Percentage']])
+REGISTRY.register('postflop_stats', PostFlopStats,
+                  columns=['Saw_Flop', 'CBet_Percentage', 'Fold_To_CBet_Percentage', 'Aggression_Factor',
+                           'WTSD_Percentage'])
+
+# Order the families were merged in before the registry, later families overwrite shared columns
+MERGE_ORDER = ['play_stats', 'win_stats', 'preflop_stats', 'ledger_stats', 'position_stats', 'postflop_stats']
+
+
+class LazyStats:
+    """
+    Builds stat families of a game on first use and keeps them, so asking for a few columns only pays
+    for the families (and dependencies and inputs) that produce them, e.g. VPIP_Percentage builds
+    PlayStats alone
+    """
+
+    def __init__(self, game, registry=REGISTRY, families=None):
+        self.game = game
+        self.registry = registry
+        # Already built families, e.g. from parse_parallel, have all their inputs
+        self.built = dict(families or {})
+        self.built_inputs = {name: registry.inputs_for(name) for name in self.built}
+        self.dicts = {}
+
+    def family(self, name, inputs=()):
+        if name not in self.built or not set(inputs) <= self.built_inputs[name]:
+            build, dependencies, _, _ = self.registry.families[name]
+            # Rebuilt with everything asked for so far when a later column needs another input
+            inputs = set(inputs) | self.built_inputs.get(name, set())
+            self.built[name] = build(self.game, *[self.family(x) for x in dependencies],
+                                     **{x: self.family(x) for x in inputs})
+            self.built_inputs[name] = inputs
+            self.dicts.pop(name, None)
+        return self.built[name]
+
+    def as_dict(self, name):
+        if name not in self.dicts:
+            self.dicts[name] = self.family(name).as_dict()
+        return self.dicts[name]
+
+    def columns(self, columns=None):
+        """
+        Player to {column: value} for the requested columns (all registered columns for None)
+        """
+        # Dependencies are built as needed but only families owning a requested column are reported
+        reported = self.registry.families_for(columns)
+        ordered = [x for x in MERGE_ORDER if x in reported] + [x for x in reported if x not in MERGE_ORDER]
+
+        result = defaultdict(dict)
+        for name in ordered:
+            self.family(name, reported[name])
+            for row in self.as_dict(name):
+                result[row['Player']].update({k: v for k, v in row.items()
+                                              if k != 'Player' and (columns is None or k in columns)})
+        return result
@@ -0,0 +1,218 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import NamedTuple, Tuple
+import boto3 as b3
+from boto3.dynamodb.conditions import Attr
+from db import get_stats_version
+
+
+class SessionStats(NamedTuple):
+    player: str
+    date_played: str
+    total_rounds: int
+    rounds_played: int
+    rounds_won: int
+    vpip_percentage: float
+    pfr_percentage: float
+    win_percentage: float
+    buy_in: float
+    profit_loss: float
+
+
+class PlayerSeasonSummary(NamedTuple):
+    player: str
+    season: str
+    sessions: int
+    total_rounds: int
+    rounds_played: int
+    rounds_won: int
+    vpip_percentage: float
+    win_percentage: float
+    buy_in: float
+    profit_loss: float
+
+
+class MonthStats(NamedTuple):
+    player: str
+    month: str
+    total_rounds: int
+    rounds_played: int
+    rounds_won: int
+    rounds_raised: int
+    rounds_limped: int
+    showdowns_won: int
+    showdowns_faced: int
+    vpip_percentage: float
+    pfr_percentage: float
+    win_percentage: float
+    buy_in: float
+
+
+def _number(value):
+    if value is None:
+        return 0.0
+    return float(str(value).strip().rstrip('%') or 0)
+
+
+def _count(value):
+    return int(_number(value))
+
+
+def _scan(table_name, filter_expression, dynamodb):
+    """
+    Scan a table following LastEvaluatedKey, get_stats_by_date only returns the first page
+    """
+    table = dynamodb.Table(table_name)
+    kwargs = {'FilterExpression': filter_expression}
+    items = []
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+class StatsCache:
+    """
+    Bounded LRU cache whose entries expire after ttl seconds, or as soon as compute_stats bumps the
+    stats version. Concurrent misses on the same key share a single load.
+    """
+
+    def __init__(self, dynamodb=None, maxsize=256, ttl=60, version_ttl=5):
+        self.dynamodb = dynamodb
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # How long a fetched version is trusted before asking DynamoDB again
+        self.version_ttl = version_ttl
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._version_lock = threading.Lock()
+        self._version = None
+        self._version_expires = 0
+
+    def _current_version(self):
+        with self._version_lock:
+            now = time.monotonic()
+            if self._version is None or now >= self._version_expires:
+                self._version = get_stats_version(self.dynamodb)
+                self._version_expires = now + self.version_ttl
+            return self._version
+
+    def get(self, key, loader):
+        version = self._current_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, expires, value = entry
+                if entry_version == version and time.monotonic() < expires:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+            future = self._pending.get((key, version))
+            owner = future is None
+            if owner:
+                future = Future()
+                self._pending[(key, version)] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self._pending.pop((key, version), None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._pending.pop((key, version), None)
+            self._entries[key] = (version, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        with self._version_lock:
+            self._version = None
+
+
+class StatsQueries:
+    def __init__(self, dynamodb=None, cache=None):
+        if not dynamodb:
+            dynamodb = b3.resource('dynamodb', region_name='us-east-1')
+        self.dynamodb = dynamodb
+        self.cache = cache if cache is not None else StatsCache(dynamodb)
+
+    def session_list(self, player) -> Tuple[SessionStats, ...]:
+        return self.cache.get(('session_list', player), lambda: self._load_sessions(player))
+
+    def player_season_summary(self, player, season) -> PlayerSeasonSummary:
+        """
+        season is matched against the start of Date_Played, like get_stats_by_date
+        """
+        return self.cache.get(('player_season_summary', player, season),
+                              lambda: self._load_season_summary(player, season))
+
+    def month_table(self, month) -> Tuple[MonthStats, ...]:
+        return self.cache.get(('month_table', month), lambda: self._load_month(month))
+
+    def _load_sessions(self, player):
+        items = _scan('stats_by_date', Attr('Player').eq(player), self.dynamodb)
+        sessions = [SessionStats(player=item['Player'],
+                                 date_played=item['Date_Played'],
+                                 total_rounds=_count(item.get('Total_Rounds')),
+                                 rounds_played=_count(item.get('Rounds_Played')),
+                                 rounds_won=_count(item.get('Rounds_Won')),
+                                 vpip_percentage=_number(item.get('VPIP_Percentage')),
+                                 pfr_percentage=_number(item.get('PFR_Percentage')),
+                                 win_percentage=_number(item.get('Win_Percentage')),
+                                 buy_in=_number(item.get('BuyIn')),
+                                 profit_loss=_number(item.get('Profit_Loss')))
+                    for item in items]
+        return tuple(sorted(sessions, key=lambda x: x.date_played))
+
+    def _load_season_summary(self, player, season):
+        sessions = [x for x in self.session_list(player) if x.date_played.startswith(season)]
+        total_rounds = sum(x.total_rounds for x in sessions)
+        rounds_played = sum(x.rounds_played for x in sessions)
+        rounds_won = sum(x.rounds_won for x in sessions)
+        vpip = rounds_played / total_rounds * 100 if total_rounds else 0
+        win = rounds_won / rounds_played * 100 if rounds_played else 0
+        return PlayerSeasonSummary(player=player,
+                                   season=season,
+                                   sessions=len(sessions),
+                                   total_rounds=total_rounds,
+                                   rounds_played=rounds_played,
+                                   rounds_won=rounds_won,
+                                   vpip_percentage=round(vpip, 2),
+                                   win_percentage=round(win, 2),
+                                   buy_in=sum(x.buy_in for x in sessions),
+                                   profit_loss=round(sum(x.profit_loss for x in sessions), 2))
+
+    def _load_month(self, month):
+        items = _scan('stats_by_month', Attr('SK').begins_with(f"{month}"), self.dynamodb)
+        rows = [MonthStats(player=item['PK'],
+                           month=item['SK'],
+                           total_rounds=_count(item.get('Total_Rounds')),
+                           rounds_played=_count(item.get('Rounds_Played')),
+                           rounds_won=_count(item.get('Rounds_Won')),
+                           rounds_raised=_count(item.get('Rounds_Raised')),
+                           rounds_limped=_count(item.get('Rounds_Limped')),
+                           showdowns_won=_count(item.get('Showdowns_Won')),
+                           showdowns_faced=_count(item.get('Showdowns_Faced')),
+                           vpip_percentage=_number(item.get('VPIP_Percentage')),
+                           pfr_percentage=_number(item.get('PFR_Percentage')),
+                           win_percentage=_number(item.get('Win_Percentage')),
+                           buy_in=_number(item.get('BuyIn')))
+                for item in items]
+        return tuple(sorted(rows, key=lambda x: x.player))